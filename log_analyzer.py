@@ -2,19 +2,37 @@
 # -*- coding: utf-8 -*-
 import json
 import sys
-from typing import Generator, Optional
-from collections import namedtuple
+from typing import Generator, Iterable, Optional
+from collections import defaultdict, namedtuple
+from functools import partial
+from itertools import islice
+from math import inf
+from heapq import nlargest
+from multiprocessing import Pool
+from operator import itemgetter
+from random import Random
 from datetime import datetime
-from statistics import mean, median
-from string import Template
-from json import dumps
+from json import dump
 import os
-import re
 import gzip
+import io
 import argparse
 import logging
 logger = logging.getLogger(__name__)
 
+_LOGFILE_NAME_PREFIX = 'nginx-access-ui.log-'
+_MEDIAN_SAMPLE_SIZE = 1024
+_READ_BUFFER_SIZE = 128 * 1024
+_PARSED_BATCH_SIZE = 4096
+_MIN_LOG_LINE_LENGTH = 32
+_HEAP_SELECTION_MIN_URLS = 1000
+_PARALLEL_MIN_FILE_SIZE = 16 * 1024 * 1024
+
+Logfile = namedtuple(typename='Logfile', field_names='path date extension')
+LogStatistic = namedtuple(typename='LogStatistic',
+                          field_names='total_lines valid_lines parsing_errors request_time '
+                                      'url_counts url_time_sums url_time_maxes url_time_samples')
+
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -30,15 +48,15 @@ def get_last_logfile_desc(log_dir: str):
         description of the file as a namedtuple with fields path, date, extension
         or None if no proper file was found
     """
-    Logfile = namedtuple(typename='Logfile', field_names='path date extension')
     res = None
     if os.path.exists(log_dir):
         with os.scandir(log_dir) as entries:
             for entry in entries:
-                if entry.is_file():
-                    date, extension = parse_logfile_name(entry.name)
-                    if date is not None and (not res or res.date < date):
-                        res = Logfile(entry.path, date, extension)
+                date, extension = parse_logfile_name(entry.name)
+                if date is None or not entry.is_file():
+                    continue
+                if not res or res.date < date:
+                    res = Logfile(entry.path, date, extension)
     return res
 
 
@@ -52,15 +70,15 @@ def parse_logfile_name(filename: str) -> tuple[Optional[datetime], Optional[str]
         - date from filename as datetime (None if filename format doesn't match the pattern)
         - extension as string (None for plain file or if filename format doesn't match the pattern)
     """
-    filename_pattern = re.compile(r"nginx-access-ui\.log-(?P<date>\d{8})(?P<extension>\.gz)?")
-    match = filename_pattern.fullmatch(filename)
     date, extension = None, None
-    if match is not None:
-        try:
-            date = datetime.strptime(match.group('date'), '%Y%m%d')
-        except ValueError as ex:
-            logger.exception(f'Failed to parse log file date (file: {filename}) ({ex.args[0]})')
-        extension = match.group('extension')
+    if filename.startswith(_LOGFILE_NAME_PREFIX):
+        date_string, separator, suffix = filename[len(_LOGFILE_NAME_PREFIX):].partition('.')
+        if len(date_string) == 8 and date_string.isdecimal() and (not separator or suffix == 'gz'):
+            try:
+                date = datetime(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]))
+            except ValueError as ex:
+                logger.exception(f'Failed to parse log file date (file: {filename}) ({ex.args[0]})')
+            extension = separator + suffix or None
     return date, extension
 
 
@@ -84,57 +102,232 @@ def get_report_filename(report_dir: str, report_date: datetime) -> Optional[str]
         return
 
 
-def parse_logfile(file_desc) -> Generator[Optional[dict], None, None]:
-    """Generator of parsed strings from the log file provided in the description
+def parse_logfile(file_desc, start: int = 0,
+                  end: Optional[int] = None) -> Generator[list[Optional[tuple[str, float]]], None, None]:
+    """Generator of parsed strings from the log file provided in the description, yielded in batches
 
     :param file_desc:
         description of the file as a namedtuple with fields path, date, extension
+    :param start:
+        offset of the first string to parse (plain files only)
+    :param end:
+        offset after the last string to parse, must be at the string boundary (plain files only)
     :yield:
-        dictionary with url and request time from log string (None if parsing has been failed)
+        list of up to 4096 tuples of url and request time from log strings
+        (None for every string if parsing has been failed)
     """
-    opener = gzip.open if file_desc.extension == '.gz' else open
     try:
-        with opener(file_desc.path, 'rt', encoding='utf-8') as file:
-            for line in file:
-                yield parse_logfile_line(line)
+        if file_desc.extension == '.gz':
+            file = io.BufferedReader(gzip.open(file_desc.path, 'rb'), buffer_size=_READ_BUFFER_SIZE)
+        else:
+            file = open(file_desc.path, 'rb', buffering=_READ_BUFFER_SIZE)
+        with file:
+            if start:
+                file.seek(start)
+            lines = file if end is None else _read_lines(file, end - start)
+            # map and islice drive the per-line loop in C, the generator only resumes once per batch
+            parsed_lines = map(parse_logfile_line, lines)
+            while batch := list(islice(parsed_lines, _PARSED_BATCH_SIZE)):
+                yield batch
     except OSError as ex:
         logger.exception(f'Error while opening log file {file_desc.path}: {ex.strerror}')
         return
 
 
-def parse_logfile_line(line: str) -> Optional[dict[datetime, Optional[str]]]:
+def _read_lines(file, size: int) -> Generator[bytes, None, None]:
+    if size <= 0:
+        return
+    for line in file:
+        yield line
+        size -= len(line)
+        if size <= 0:
+            return
+
+
+def get_logfile_chunks(path: str, chunks_number: int) -> list[tuple[int, int]]:
+    """Split the plain log file into byte ranges aligned to string boundaries
+
+    :param path:
+        log file path
+    :param chunks_number:
+        desired number of chunks
+    :return:
+        list of tuples with start and end offsets of every non-empty chunk
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, chunks_number):
+            file.seek(max(size * i // chunks_number, bounds[-1]))
+            file.readline()
+            bounds.append(file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def parse_logfile_line(line: bytes) -> Optional[tuple[str, float]]:
     """Check if log string matches the format below and then extract url and request time
 
+    The request is taken from the first quoted field and request time from the last field of the string
+
             log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
             '$status $body_bytes_sent "$http_referer" '
             '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
             '$request_time'
 
     :param line:
-        string from log file
+        raw string from log file
     :return:
-        dictionary with url as string and request time as float from log string (None if parsing has been failed)
+        tuple of url as string and request time as float from log string (None if parsing has been failed)
     """
-    log_pattern = re.compile(r"^.+?\"\S+\s+(?P<url>\S+).+\"\s+(?P<request_time>\S+)$")
-    match = log_pattern.match(line)
     res = None
-    if match is not None:
+    # too short strings and strings without quotes are rejected before any slicing
+    request_start = line.find(b'"') if len(line) >= _MIN_LOG_LINE_LENGTH else -1
+    request_end = line.find(b'"', request_start + 1) if request_start > 0 else -1
+    request = line[request_start + 1:request_end].split(None, 2) if request_end > 0 else ()
+    if len(request) > 1:
+        _, _, request_time = line.rstrip().rpartition(b' ')
         try:
-            res = {'url': match.group('url'), 'request_time': float(match.group('request_time'))}
+            url, time = request[1].decode(), float(request_time)
         except ValueError as ex:
-            logger.exception(f'Failed to parse request_time (line: {line}) ({ex.args[0]})')
-    else:
-        logger.info(f'Failed to parse log file - invalid format (line: {line})')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Failed to parse url or request_time '
+                             f'(line: {line.decode(errors="replace").rstrip()}) ({ex.args[0]})')
+        else:
+            # nan, inf and negative values are accepted by float() but would only corrupt the sums
+            if 0.0 <= time < inf:
+                res = url, time
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Failed to parse request_time - not a finite non-negative value '
+                             f'(line: {line.decode(errors="replace").rstrip()})')
+    elif logger.isEnabledFor(logging.INFO):
+        logger.info(f'Failed to parse log file - invalid format (line: {line.decode(errors="replace").rstrip()})')
     return res
 
 
-def create_statistic_data(parsed_log_lines: Generator[Optional[dict], None, None],
-                          error_limit: float,
-                          report_size: int):
-    """Calculate time statistic for top-(report_size) requests
+def aggregate_parsed_lines(parsed_log_batches: Iterable[list[Optional[tuple[str, float]]]],
+                           seed: int = 0) -> LogStatistic:
+    """Accumulate line counters and per-url request time aggregates
 
-    :param parsed_log_lines:
-        generator of dictionaries with url and request time for every line in log file
+    Only a sample of request times is kept for every url, so the median is exact
+    for urls with up to 1024 requests and estimated for the others. The sample is drawn
+    with a seeded generator, so the same log always gives the same estimate
+
+    :param parsed_log_batches:
+        iterable of lists of tuples of url and request time for every line in log file
+    :param seed:
+        seed of the random generator used for sampling request times
+    :return:
+        aggregated data as a namedtuple LogStatistic
+    """
+    total_lines_counter, valid_lines_counter, parsing_error_counter, request_time_counter = 0, 0, 0, 0.0
+    url_counts, url_time_sums = defaultdict(int), defaultdict(float)
+    url_time_maxes, url_time_samples = defaultdict(float), defaultdict(list)
+    rng = Random(seed)
+    for batch in parsed_log_batches:
+        total_lines_counter += len(batch)
+        for parsed_line in batch:
+            if parsed_line is not None:
+                url, time = parsed_line
+                count = url_counts[url] + 1
+                url_counts[url] = count
+                url_time_sums[url] += time
+                if time > url_time_maxes[url]:
+                    url_time_maxes[url] = time
+                if count <= _MEDIAN_SAMPLE_SIZE:
+                    url_time_samples[url].append(time)
+                else:
+                    # reservoir sampling keeps a uniform sample of request times for the median
+                    index = rng.randrange(count)
+                    if index < _MEDIAN_SAMPLE_SIZE:
+                        url_time_samples[url][index] = time
+                valid_lines_counter += 1
+                request_time_counter += time
+            else:
+                parsing_error_counter += 1
+    return LogStatistic(total_lines_counter, valid_lines_counter, parsing_error_counter, request_time_counter,
+                        url_counts, url_time_sums, url_time_maxes, url_time_samples)
+
+
+def merge_log_statistics(log_statistics: Iterable[LogStatistic]) -> Optional[LogStatistic]:
+    """Merge aggregated data of several log file chunks
+
+    :param log_statistics:
+        iterable of namedtuples LogStatistic
+    :return:
+        merged data as a namedtuple LogStatistic (None if there is nothing to merge)
+    """
+    res = None
+    rng = Random(0)
+    for log_statistic in log_statistics:
+        if res is None:
+            res = log_statistic
+            continue
+        for url, count in log_statistic.url_counts.items():
+            res_count = res.url_counts[url]
+            res.url_time_samples[url] = _merge_time_samples(res.url_time_samples[url], res_count,
+                                                            log_statistic.url_time_samples[url], count, rng)
+            res.url_counts[url] = res_count + count
+            res.url_time_sums[url] += log_statistic.url_time_sums[url]
+            res.url_time_maxes[url] = max(res.url_time_maxes[url], log_statistic.url_time_maxes[url])
+        res = res._replace(total_lines=res.total_lines + log_statistic.total_lines,
+                           valid_lines=res.valid_lines + log_statistic.valid_lines,
+                           parsing_errors=res.parsing_errors + log_statistic.parsing_errors,
+                           request_time=res.request_time + log_statistic.request_time)
+    return res
+
+
+def _merge_time_samples(first: list[float], first_count: int, second: list[float], second_count: int,
+                        rng: Random) -> list[float]:
+    # both samples are taken proportionally to the number of requests they represent
+    if len(first) + len(second) <= _MEDIAN_SAMPLE_SIZE:
+        return first + second
+    first_size = min(round(_MEDIAN_SAMPLE_SIZE * first_count / (first_count + second_count)), len(first))
+    second_size = min(_MEDIAN_SAMPLE_SIZE - first_size, len(second))
+    return rng.sample(first, first_size) + rng.sample(second, second_size)
+
+
+def _process_chunk(file_desc, chunk: tuple[int, int]) -> LogStatistic:
+    # every chunk is sampled with its own seed, so the result doesn't depend on the scheduling
+    return aggregate_parsed_lines(parse_logfile(file_desc, *chunk), seed=chunk[0])
+
+
+def collect_log_statistic(file_desc, workers: int, min_size: int = _PARALLEL_MIN_FILE_SIZE,
+                          log_file: Optional[str] = None) -> LogStatistic:
+    """Parse the log file and aggregate its data, plain files are split between worker processes
+
+    Gzip files can't be read from an arbitrary offset, so they are always processed in a single pass,
+    as well as files smaller than min_size, for which starting the worker processes costs more than it saves
+
+    :param file_desc:
+        description of the file as a namedtuple with fields path, date, extension
+    :param workers:
+        number of worker processes
+    :param min_size:
+        minimal size of the plain file in bytes to split it between worker processes
+    :param log_file:
+        path to the file for script logging in worker processes (None for stderr)
+    :return:
+        aggregated data as a namedtuple LogStatistic
+    """
+    if file_desc.extension != '.gz' and workers > 1:
+        try:
+            chunks = get_logfile_chunks(file_desc.path, workers) if os.path.getsize(file_desc.path) >= min_size else []
+        except OSError:
+            # the single pass below reports the error while opening the file
+            chunks = []
+        if len(chunks) > 1:
+            with Pool(len(chunks), initializer=setup_logging, initargs=(log_file,)) as pool:
+                # chunks are merged in file order, so the merged median sample is reproducible
+                return merge_log_statistics(pool.imap(partial(_process_chunk, file_desc), chunks))
+    return aggregate_parsed_lines(parse_logfile(file_desc))
+
+
+def build_statistic_data(log_statistic: LogStatistic, error_limit: float, report_size: int):
+    """Calculate time statistic for top-(report_size) requests from aggregated log data
+
+    :param log_statistic:
+        aggregated data as a namedtuple LogStatistic
     :param error_limit:
         allowed parsing error rate
     :param report_size:
@@ -143,40 +336,58 @@ def create_statistic_data(parsed_log_lines: Generator[Optional[dict], None, None
         list of dictionaries with statistical data:
         url, count, count_perc, time_sum, time_perc, time_avg, time_max, time_med
     """
-    total_lines_counter, valid_lines_counter, parsing_error_counter, request_time_counter = 0, 0, 0, 0.0
-    urls = {}
-    for parsed_line in parsed_log_lines:
-        total_lines_counter += 1
-        if parsed_line is not None:
-            url = parsed_line['url']
-            time = parsed_line['request_time']
-            if url in urls.keys():
-                urls[url].append(time)
-            else:
-                urls[url] = [time]
-            valid_lines_counter += 1
-            request_time_counter += time
-        else:
-            parsing_error_counter += 1
-
-    if total_lines_counter == 0:
+    if log_statistic.total_lines == 0:
         logger.info('Log file was not read. Cannot create statistical report.')
         return
 
-    error_rate = parsing_error_counter / total_lines_counter
+    error_rate = log_statistic.parsing_errors / log_statistic.total_lines
     if error_rate >= error_limit:
         logger.info(f'Parsing error limit has been exceeded (error percentage: {round(error_rate * 100, 2)})')
         return
 
-    return [{'url': url,
-             'count': len(time_list),
-             'count_perc': round(len(time_list) / valid_lines_counter * 100, 3),
-             'time_sum': round(sum(time_list), 3),
-             'time_perc': round(sum(time_list) / request_time_counter * 100, 3),
-             'time_avg': round(mean(time_list), 3),
-             'time_max': round(max(time_list), 3),
-             'time_med': round(median(time_list), 3)}
-            for url, time_list in sorted(urls.items(), key=lambda x: sum(x[1]), reverse=True)[:min(report_size, len(urls.items()))]]
+    url_time_sums = log_statistic.url_time_sums
+    urls_number = len(url_time_sums)
+    # the heap only pays off when the report is much smaller than the number of urls
+    if urls_number < _HEAP_SELECTION_MIN_URLS or report_size >= urls_number // 2:
+        top_urls = sorted(url_time_sums.items(), key=itemgetter(1), reverse=True)[:report_size]
+    else:
+        top_urls = nlargest(report_size, url_time_sums.items(), key=itemgetter(1))
+
+    statistic_data = []
+    for url, time_sum in top_urls:
+        count = log_statistic.url_counts[url]
+        # the sample order doesn't matter, so it is sorted in place instead of copied by statistics.median
+        time_sample = log_statistic.url_time_samples[url]
+        time_sample.sort()
+        middle = len(time_sample) // 2
+        time_med = time_sample[middle] if len(time_sample) % 2 else (time_sample[middle - 1] + time_sample[middle]) / 2
+        statistic_data.append({'url': url,
+                               'count': count,
+                               'count_perc': round(count / log_statistic.valid_lines * 100, 3),
+                               'time_sum': round(time_sum, 3),
+                               'time_perc': round(time_sum / log_statistic.request_time * 100, 3),
+                               'time_avg': round(time_sum / count, 3),
+                               'time_max': round(log_statistic.url_time_maxes[url], 3),
+                               'time_med': round(time_med, 3)})
+    return statistic_data
+
+
+def create_statistic_data(parsed_log_lines: Iterable[list[Optional[tuple[str, float]]]],
+                          error_limit: float,
+                          report_size: int):
+    """Calculate time statistic for top-(report_size) requests
+
+    :param parsed_log_lines:
+        iterable of lists of tuples of url and request time for every line in log file
+    :param error_limit:
+        allowed parsing error rate
+    :param report_size:
+        number of urls for return
+    :return:
+        list of dictionaries with statistical data:
+        url, count, count_perc, time_sum, time_perc, time_avg, time_max, time_med
+    """
+    return build_statistic_data(aggregate_parsed_lines(parsed_log_lines), error_limit, report_size)
 
 
 def save_report(report_template_file: str, statistic_data: list[dict], report_filename: str):
@@ -197,9 +408,12 @@ def save_report(report_template_file: str, statistic_data: list[dict], report_fi
         return False
     with open(report_template_file, 'r', encoding='utf-8') as file:
         pattern = file.read()
-    report = Template(pattern).safe_substitute(table_json=dumps(statistic_data))
+    head, placeholder, tail = pattern.partition('$table_json')
     with open(report_filename, 'w+', encoding='utf-8') as file:
-        file.write(report)
+        file.write(head)
+        if placeholder:
+            dump(statistic_data, file, separators=(',', ':'))
+        file.write(tail)
         return True
 
 
@@ -227,20 +441,45 @@ def update_config(old_config, new_config_path):
         return
 
 
-def main(config_info):
-    """Get log file according to configuration, parse it and create statistical report by template
+def get_workers_number() -> int:
+    """Get the number of CPUs the script is allowed to run on
 
-    :param config_info:
-        dictionary with actual configuration
+    :return:
+        number of CPUs from the process affinity mask if the platform provides it, total number of CPUs otherwise
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def setup_logging(log_file: Optional[str]):
+    """Configure script logging, also used as the initializer of worker processes
+
+    With the spawn start method (Windows, macOS) workers don't inherit the configuration of the main process.
+    With fork they already have it, and this call changes nothing
+
+    :param log_file:
+        path to the file for script logging (None for stderr)
     :return:
         None
     """
-    logging.basicConfig(filename=config_info['LOG_FILE'],
+    logging.basicConfig(filename=log_file,
                         encoding='utf-8',
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S',
                         level=logging.INFO)
 
+
+def main(config_info):
+    """Get log file according to configuration, parse it and create statistical report by template
+
+    :param config_info:
+        dictionary with actual configuration
+    :return:
+        None
+    """
+    setup_logging(config_info['LOG_FILE'])
+
     logfile_desc = get_last_logfile_desc(config_info['LOG_DIR'])
     if logfile_desc is None:
         logger.info('No log file for processing')
@@ -252,9 +491,9 @@ def main(config_info):
         logger.info('Report file was not created')
         return
 
-    parsed_log_lines = parse_logfile(logfile_desc)
     logger.info('Statistical report creation was started')
-    statistic_data = create_statistic_data(parsed_log_lines, config_info['ERROR_LIMIT'], config_info['REPORT_SIZE'])
+    log_statistic = collect_log_statistic(logfile_desc, get_workers_number(), log_file=config_info['LOG_FILE'])
+    statistic_data = build_statistic_data(log_statistic, config_info['ERROR_LIMIT'], config_info['REPORT_SIZE'])
     logger.info('Statistical report creation was ended')
     if statistic_data is not None and save_report(config_info['REPORT_TEMPLATE_FILE'], statistic_data, report_filename):
         logger.info(f'Report file for {logfile_desc.date.strftime("%Y.%m.%d")} was created')
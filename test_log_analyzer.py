@@ -29,6 +29,9 @@ class TestLogFileParsing(unittest.TestCase):
         self.assertTupleEqual(parse_logfile_name(self.tempfile_valid_gz_new), (datetime(2017, 6, 30), '.gz'))
         self.assertTupleEqual(parse_logfile_name(self.tempfile_invalid_ext), (None, None))
         self.assertTupleEqual(parse_logfile_name(self.tempfile_invalid_name), (None, None))
+        self.assertTupleEqual(parse_logfile_name('nginx-access-ui.log-201706301'), (None, None))
+        self.assertTupleEqual(parse_logfile_name('nginx-access-ui.log-20170630.gz.bak'), (None, None))
+        self.assertTupleEqual(parse_logfile_name('other-nginx-access-ui.log-20170630'), (None, None))
 
     def test_get_last_logfile_desc(self):
         Logfile = namedtuple(typename='Logfile', field_names='path date extension')
@@ -37,12 +40,61 @@ class TestLogFileParsing(unittest.TestCase):
                                       '.gz'))
 
     def test_parse_logfile_line(self):
-        valid_line = '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
-        invalid_format = 'GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1 1.99.174.176 3b81f63528 - [29/Jun/2017:03:50:22 +0300] 0.133\n'
-        invalid_request_time = '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.1.99\n'
-        self.assertEqual(parse_logfile_line(valid_line), {'url': '/api/v2/banner/25019354', 'request_time': 0.39})
+        valid_line = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
+        invalid_format = b'GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1 1.99.174.176 3b81f63528 - [29/Jun/2017:03:50:22 +0300] 0.133\n'
+        invalid_request_time = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.1.99\n'
+        self.assertEqual(parse_logfile_line(valid_line), ('/api/v2/banner/25019354', 0.39))
         self.assertIsNone(parse_logfile_line(invalid_format))
         self.assertIsNone(parse_logfile_line(invalid_request_time))
+        self.assertIsNone(parse_logfile_line(b'"GET / HTTP/1.1" 0.390\n'))
+        self.assertIsNone(parse_logfile_line(b'\n'))
+        self.assertEqual(parse_logfile_line(valid_line.replace(b'"GET /', b'"GET  /')), ('/api/v2/banner/25019354', 0.39))
+        self.assertIsNone(parse_logfile_line(valid_line.replace(b' 0.390', b' nan')))
+        self.assertIsNone(parse_logfile_line(valid_line.replace(b' 0.390', b' -0.390')))
+        self.assertIsNone(parse_logfile_line(valid_line.replace(b' 0.390', b' inf')))
+        self.assertEqual(parse_logfile_line(valid_line.replace(b' 0.390', b' 12')), ('/api/v2/banner/25019354', 12.0))
+
+    def test_parse_logfile(self):
+        lines = [b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n',
+                 b'GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1 1.99.174.176 3b81f63528 - [29/Jun/2017:03:50:22 +0300] 0.133\n']
+        Logfile = namedtuple(typename='Logfile', field_names='path date extension')
+        with gzip.open(os.path.join(self.tempdir, self.tempfile_valid_gz_new), 'wb') as file:
+            file.writelines(lines)
+        with open(os.path.join(self.tempdir, self.tempfile_valid_plain_old), 'wb') as file:
+            file.writelines(lines)
+        ref_sample = [[('/api/v2/banner/25019354', 0.39), None]]
+        self.assertListEqual(list(parse_logfile(Logfile(os.path.join(self.tempdir, self.tempfile_valid_gz_new),
+                                                        datetime(2017, 6, 30), '.gz'))), ref_sample)
+        self.assertListEqual(list(parse_logfile(Logfile(os.path.join(self.tempdir, self.tempfile_valid_plain_old),
+                                                        datetime(2017, 6, 29), None))), ref_sample)
+
+    def test_collect_log_statistic(self):
+        path = os.path.join(self.tempdir, self.tempfile_valid_plain_old)
+        with open(path, 'wb') as file:
+            for i in range(500):
+                file.write(f'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{i % 7} HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" {i / 100}\n'.encode())
+            file.write(b'invalid line\n')
+        chunks = get_logfile_chunks(path, 4)
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(path))
+        self.assertTrue(all(prev[1] == cur[0] for prev, cur in zip(chunks, chunks[1:])))
+
+        file_desc = Logfile(path, datetime(2017, 6, 29), None)
+        ref_statistic = aggregate_parsed_lines(parse_logfile(file_desc))
+        log_statistic = collect_log_statistic(file_desc, 4, min_size=0)
+        self.assertEqual(log_statistic.total_lines, 501)
+        self.assertEqual(log_statistic.parsing_errors, 1)
+        self.assertEqual(log_statistic.url_counts, ref_statistic.url_counts)
+        self.assertEqual(log_statistic.url_time_maxes, ref_statistic.url_time_maxes)
+        for url, time_sum in ref_statistic.url_time_sums.items():
+            self.assertAlmostEqual(log_statistic.url_time_sums[url], time_sum)
+            self.assertListEqual(sorted(log_statistic.url_time_samples[url]),
+                                 sorted(ref_statistic.url_time_samples[url]))
+
+        missing_file_desc = Logfile(os.path.join(self.tempdir, 'nginx-access-ui.log-20170601'),
+                                    datetime(2017, 6, 1), None)
+        self.assertEqual(collect_log_statistic(missing_file_desc, 4, min_size=0).total_lines, 0)
 
 
 class TestReportCreating(unittest.TestCase):
@@ -61,10 +113,10 @@ class TestReportCreating(unittest.TestCase):
                          os.path.join(self.tempdir, 'report-2017.06.29.html'))
 
     def test_create_statistic_data(self):
-        valid_line = '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
-        invalid_format = 'GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1 1.99.174.176 3b81f63528 - [29/Jun/2017:03:50:22 +0300] 0.133\n'
-        invalid_request_time = '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.1.99\n'
-        parsed_lines = map(parse_logfile_line, [valid_line, invalid_format, invalid_request_time])
+        valid_line = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
+        invalid_format = b'GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1 1.99.174.176 3b81f63528 - [29/Jun/2017:03:50:22 +0300] 0.133\n'
+        invalid_request_time = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.1.99\n'
+        parsed_lines = iter([list(map(parse_logfile_line, [valid_line, invalid_format, invalid_request_time]))])
         ref_sample = [{'url': '/api/v2/banner/25019354',
                        'count': 1, 'count_perc': 100.0,
                        'time_sum': 0.39,
@@ -77,6 +129,49 @@ class TestReportCreating(unittest.TestCase):
         self.assertIsNone(create_statistic_data([], 0.8, 10))
         self.assertIsNone(create_statistic_data(parsed_lines, 0.1, 10))
 
+    def test_create_statistic_data_top_urls(self):
+        parsed_lines = [(f'/api/v2/banner/{i}', i / 10) for i in range(1, 11)]
+        parsed_lines.append(('/api/v2/banner/1', 0.45))
+        statistic_data = create_statistic_data([parsed_lines], 0.5, 3)
+        self.assertListEqual([row['url'] for row in statistic_data],
+                             ['/api/v2/banner/10', '/api/v2/banner/9', '/api/v2/banner/8'])
+        statistic_data = create_statistic_data([parsed_lines], 0.5, 10)
+        self.assertEqual(len(statistic_data), 10)
+        self.assertEqual(statistic_data[-1]['url'], '/api/v2/banner/2')
+        self.assertEqual(statistic_data[5]['url'], '/api/v2/banner/1')
+        self.assertEqual(statistic_data[5]['count'], 2)
+        self.assertEqual(statistic_data[5]['time_med'], 0.275)
+        self.assertEqual(statistic_data[5]['time_max'], 0.45)
+
+        parsed_lines = [(f'/api/v2/banner/{i}', i / 1000) for i in range(1, 5001)]
+        statistic_data = create_statistic_data([parsed_lines], 0.5, 3)
+        self.assertListEqual([row['url'] for row in statistic_data],
+                             ['/api/v2/banner/5000', '/api/v2/banner/4999', '/api/v2/banner/4998'])
+
+    def test_create_statistic_data_frequent_url(self):
+        parsed_lines = [('/api/v2/banner/25019354', i / 1000) for i in range(3000)]
+        statistic_data = create_statistic_data([parsed_lines], 0.5, 10)
+        self.assertEqual(len(statistic_data), 1)
+        self.assertEqual(statistic_data[0]['count'], 3000)
+        self.assertEqual(statistic_data[0]['time_sum'], 4498.5)
+        self.assertEqual(statistic_data[0]['time_max'], 2.999)
+        self.assertAlmostEqual(statistic_data[0]['time_med'], 1.5, delta=0.3)
+        shuffled_lines = parsed_lines[1::2] + parsed_lines[::2]
+        self.assertEqual(create_statistic_data([shuffled_lines], 0.5, 10),
+                         create_statistic_data([shuffled_lines], 0.5, 10))
+
+    def test_save_report(self):
+        template_file = os.path.join(self.tempdir, 'report.html')
+        report_file = os.path.join(self.tempdir, 'report-2017.06.29.html')
+        with open(template_file, 'w', encoding='utf-8') as file:
+            file.write('<script>var $table = $(".report"); var table = $table_json;</script>')
+        statistic_data = [{'url': '/api/v2/banner/25019354', 'count': 1, 'time_sum': 0.39}]
+        self.assertTrue(save_report(template_file, statistic_data, report_file))
+        with open(report_file, 'r', encoding='utf-8') as file:
+            self.assertEqual(file.read(), '<script>var $table = $(".report"); var table = '
+                                          '[{"url":"/api/v2/banner/25019354","count":1,"time_sum":0.39}];</script>')
+        self.assertFalse(save_report(os.path.join(self.tempdir, 'missing.html'), statistic_data, report_file))
+
 
 class TestConfigUpdating(unittest.TestCase):
     def setUp(self):